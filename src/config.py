@@ -15,10 +15,11 @@ class Config:
     REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
     REDIS_DB = int(os.getenv("REDIS_DB", 0))
     REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 256))  # 每个进程的连接池上限
+    REDIS_HEALTH_CHECK_INTERVAL = 30  # 空闲连接健康检查间隔（秒）
     
     # Rate Limiter 配置
     SLIDING_WINDOW_SIZE_SECONDS = 60  # 滑动窗口大小（秒）
-    WINDOW_SEGMENTS = 12  # 窗口分段数（每5秒一个段）
     
     # API 默认限制
     DEFAULT_RATE_LIMITS = {
@@ -37,8 +38,10 @@ class Config:
     # 服务器配置
     SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
     SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+    SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 1))  # 同一端口上的 worker 进程数
     
     # Mock 响应配置
+    MOCK_RESPONSE_ENABLE_DELAY = os.getenv("MOCK_RESPONSE_ENABLE_DELAY", "1") != "0"  # 是否模拟响应延迟
     MOCK_RESPONSE_DELAY_MIN = 0.1  # 最小响应延迟（秒）
     MOCK_RESPONSE_DELAY_MAX = 0.5  # 最大响应延迟（秒）
     
@@ -8,6 +8,16 @@ import time
 import uuid
 
 
+def generate_completion_id() -> str:
+    """生成聊天补全响应 ID"""
+    return f"chatcmpl-{uuid.uuid4().hex[:8]}"
+
+
+def current_timestamp() -> int:
+    """当前 Unix 时间戳（秒）"""
+    return int(time.time())
+
+
 class ChatMessage(BaseModel):
     """聊天消息模型"""
     role: str
@@ -47,9 +57,9 @@ class Choice(BaseModel):
 
 class ChatCompletionResponse(BaseModel):
     """聊天补全响应模型"""
-    id: str = Field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex[:8]}")
+    id: str = Field(default_factory=generate_completion_id)
     object: str = "chat.completion"
-    created: int = Field(default_factory=lambda: int(time.time()))
+    created: int = Field(default_factory=current_timestamp)
     model: str
     choices: List[Choice]
     usage: Usage
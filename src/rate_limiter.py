@@ -2,15 +2,84 @@
 分布式 Rate Limiter 核心实现
 使用 Redis 和滑动窗口算法
 """
-import asyncio
-import time
-from typing import Dict, Tuple, Optional
+import math
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Tuple, Optional
 import redis.asyncio as redis
-from datetime import datetime, timedelta
-import json
+from redis.exceptions import NoScriptError
+from datetime import datetime
 import tiktoken
 from src.config import Config
-from src.models import ChatCompletionRequest, RateLimitInfo
+from src.models import ChatCompletionRequest
+
+
+# 原子化的检查与记录脚本（加权双窗口滑动计数）
+# 滑动窗口内的用量 = 上一固定窗口计数 * 权重 + 当前固定窗口计数
+# 每个固定窗口的 rpm / input_tpm / output_tpm 计数打包在一个 24 字节字符串中，
+# 依次为 3 个 64 位有符号整数，通过 BITFIELD 原子读写
+# KEYS: 当前窗口键, 上一窗口键
+# ARGV: 上一窗口权重, rpm 限制, 输入 token 限制, 输出 token 限制,
+#       输入 token 数, 输出 token 数, 过期时间（秒）
+# 返回: 是否允许, 3 个加权用量, 上一窗口的 3 个计数, 当前窗口的 3 个计数（记录前）
+CHECK_AND_RECORD_LUA = """
+local weight = tonumber(ARGV[1])
+local limits = {tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])}
+local increments = {'1', ARGV[5], ARGV[6]}
+
+local current = redis.call('BITFIELD', KEYS[1], 'GET', 'i64', 0, 'GET', 'i64', 64, 'GET', 'i64', 128)
+local previous = redis.call('BITFIELD', KEYS[2], 'GET', 'i64', 0, 'GET', 'i64', 64, 'GET', 'i64', 128)
+
+local used = {0, 0, 0}
+local allowed = 1
+for k = 1, 3 do
+    used[k] = previous[k] * weight + current[k]
+    if used[k] + tonumber(increments[k]) > limits[k] then
+        allowed = 0
+    end
+end
+
+if allowed == 1 then
+    redis.call('BITFIELD', KEYS[1],
+        'INCRBY', 'i64', 0, increments[1],
+        'INCRBY', 'i64', 64, increments[2],
+        'INCRBY', 'i64', 128, increments[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[7])
+end
+
+return {allowed, math.floor(used[1]), math.floor(used[2]), math.floor(used[3]),
+    previous[1], previous[2], previous[3], current[1], current[2], current[3]}
+"""
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """获取模型对应的 tokenizer（进程内共享，只加载一次）"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# 导入时预热，避免首个请求承担加载开销
+get_encoding("gpt-3.5-turbo")
+
+
+class RateLimitState(NamedTuple):
+    """
+    单次检查的速率限制状态（时间均为 Unix 时间戳，秒）
+    reset_time: 当前窗口的计数完全移出滑动窗口的时间（下一窗口结束）
+    *_retry_time: 超限维度能容纳本次请求的最早时间，未超限时为 None
+    """
+    api_key: str
+    input_tpm_used: int
+    output_tpm_used: int
+    rpm_used: int
+    input_tpm_limit: int
+    output_tpm_limit: int
+    rpm_limit: int
+    reset_time: int
+    requests_retry_time: Optional[float]
+    tokens_retry_time: Optional[float]
 
 
 class RateLimiter:
@@ -20,182 +89,200 @@ class RateLimiter:
         self.redis = redis_client
         self.config = Config()
         self.window_size = self.config.SLIDING_WINDOW_SIZE_SECONDS
-        self.segments = self.config.WINDOW_SEGMENTS
-        self.segment_size = self.window_size // self.segments
+        self._script_sha: Optional[str] = None
         
         # 初始化 tokenizer（用于计算 token 数量）
-        try:
-            self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        except:
-            self.encoding = tiktoken.get_encoding("cl100k_base")
-    
-    def _get_current_segment(self) -> int:
-        """获取当前时间所在的段"""
-        current_time = int(time.time())
-        return current_time // self.segment_size
-    
-    def _get_window_segments(self) -> Tuple[int, int]:
-        """获取滑动窗口的起始和结束段"""
-        current_segment = self._get_current_segment()
-        start_segment = current_segment - self.segments + 1
-        return start_segment, current_segment
-    
-    def _get_redis_keys(self, api_key: str) -> Dict[str, str]:
-        """获取 Redis 键名"""
-        return {
-            "rpm": f"rate_limit:rpm:{api_key}",
-            "input_tpm": f"rate_limit:input_tpm:{api_key}",
-            "output_tpm": f"rate_limit:output_tpm:{api_key}"
+        self.encoding = get_encoding("gpt-3.5-turbo")
+        # 角色名取值很少，缓存其 token 数
+        self._count_role_tokens = lru_cache(maxsize=64)(self.count_tokens)
+        
+        # 预先生成各 API Key 的固定响应头（限制值不会变化）
+        self._static_headers: Dict[str, Dict[str, str]] = {
+            api_key: self._build_static_headers(limits)
+            for api_key, limits in self.config.API_KEY_LIMITS.items()
         }
+        # 重置时间字符串缓存，每个窗口最多格式化一次
+        self._reset_time_cache: Tuple[Optional[int], str] = (None, "")
     
-    async def _increment_counter(self, key: str, segment: int, value: int = 1) -> None:
-        """增加计数器"""
-        field = str(segment)
-        pipe = self.redis.pipeline()
-        pipe.hincrby(key, field, value)
-        pipe.expire(key, self.window_size * 2)  # 设置过期时间为窗口大小的两倍
-        await pipe.execute()
+    def _get_window(self, now: float) -> Tuple[int, float]:
+        """获取当前固定窗口编号，以及上一窗口在滑动窗口中的权重"""
+        window_id = int(now) // self.window_size
+        elapsed = now - window_id * self.window_size
+        return window_id, (self.window_size - elapsed) / self.window_size
     
-    async def _get_window_sum(self, key: str) -> int:
-        """获取滑动窗口内的总和"""
-        start_segment, end_segment = self._get_window_segments()
+    def _get_retry_time(self, window_id: int, previous_weight: float, previous: int, current: int,
+                        increment: int, limit: int) -> Optional[float]:
+        """
+        按加权公式计算某一维度能容纳 increment 的最早时间（假设期间没有新的请求）
+        用量 = previous * 上一窗口权重 + current，当前即可容纳时返回 None
+        """
+        if previous * previous_weight + current + increment <= limit:
+            return None
+        
+        window_size = self.window_size
+        window_start = window_id * window_size
+        
+        if current + increment <= limit:
+            # 当前窗口内，等上一窗口的权重降到 (limit - increment - current) / previous 即可
+            return window_start + window_size * (1 - (limit - increment - current) / previous)
         
-        # 获取所有段的值
-        segments_to_check = [str(i) for i in range(start_segment, end_segment + 1)]
-        values = await self.redis.hmget(key, segments_to_check)
+        if increment > limit:
+            # 单次用量超过限制，永远无法容纳，以计数完全过期的时间为准
+            return window_start + 2 * window_size
         
-        # 计算总和
-        total = sum(int(v) if v else 0 for v in values)
-        return total
+        # 下一窗口内，当前窗口的计数成为按权重递减的上一窗口计数
+        return window_start + window_size * (2 - (limit - increment) / current)
     
-    async def _clean_old_segments(self, key: str) -> None:
-        """清理过期的段"""
-        start_segment, _ = self._get_window_segments()
-        
-        # 获取所有字段
-        all_fields = await self.redis.hkeys(key)
-        if not all_fields:
-            return
-        
-        # 找出需要删除的字段
-        fields_to_delete = []
-        for field in all_fields:
-            try:
-                segment = int(field)
-                if segment < start_segment:
-                    fields_to_delete.append(field)
-            except ValueError:
-                continue
-        
-        # 删除过期字段
-        if fields_to_delete:
-            await self.redis.hdel(key, *fields_to_delete)
+    def _get_redis_keys(self, api_key: str, window_id: int) -> List[str]:
+        """
+        获取 Redis 键名（使用 hash tag 保证同一 API Key 的键落在同一个槽）
+        返回: [当前窗口键, 上一窗口键]
+        """
+        return [
+            f"rate_limit:{{{api_key}}}:{window_id}",
+            f"rate_limit:{{{api_key}}}:{window_id - 1}"
+        ]
+    
+    async def load_scripts(self) -> None:
+        """预加载 Lua 脚本"""
+        self._script_sha = await self.redis.script_load(CHECK_AND_RECORD_LUA)
+    
+    async def _run_check_and_record(self, keys: List[str], *args) -> List[int]:
+        """通过 EVALSHA 执行检查与记录脚本"""
+        if self._script_sha is None:
+            await self.load_scripts()
+        try:
+            return await self.redis.evalsha(self._script_sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # Redis 重启或主从切换后脚本缓存会丢失，重新加载后重试
+            await self.load_scripts()
+            return await self.redis.evalsha(self._script_sha, len(keys), *keys, *args)
     
     def count_tokens(self, text: str) -> int:
-        """计算文本的 token 数量"""
-        return len(self.encoding.encode(text))
+        """计算文本的 token 数量（特殊 token 按普通文本处理）"""
+        return len(self.encoding.encode_ordinary(text))
     
     def estimate_request_tokens(self, request: ChatCompletionRequest) -> int:
         """估算请求的 token 数量"""
-        total_tokens = 0
-        for message in request.messages:
-            # 角色和内容的 token
-            total_tokens += self.count_tokens(message.role)
-            total_tokens += self.count_tokens(message.content)
-            # 消息格式的额外 token
-            total_tokens += 4  # 每条消息的格式开销
+        count_tokens = self.count_tokens
+        count_role_tokens = self._count_role_tokens
+        
+        # 角色和内容的 token，加上每条消息的格式开销
+        total_tokens = sum(
+            count_role_tokens(message.role) + count_tokens(message.content) + 4
+            for message in request.messages
+        )
         
         total_tokens += 2  # 对话的开始和结束标记
         return total_tokens
     
-    async def check_rate_limit(self, api_key: str, request: ChatCompletionRequest) -> Tuple[bool, Optional[RateLimitInfo]]:
+    async def check_and_record(self, api_key: str, request: ChatCompletionRequest, now: float) -> Tuple[bool, RateLimitState, int]:
         """
-        检查速率限制
-        返回: (是否允许请求, 速率限制信息)
+        原子化地检查速率限制并记录使用量
+        输出 token 按 max_tokens（或默认值）预占
+        返回: (是否允许请求, 速率限制信息, 输入 token 数)
         """
         # 获取 API Key 的限制
         limits = self.config.get_api_key_limits(api_key)
         
-        # 获取 Redis 键
-        keys = self._get_redis_keys(api_key)
-        
         # 估算请求的 token 数量
         input_tokens = self.estimate_request_tokens(request)
         
         # 估算输出 token（使用 max_tokens 或默认值）
         output_tokens = request.max_tokens if request.max_tokens else 1000
         
-        # 获取当前使用量
-        current_rpm = await self._get_window_sum(keys["rpm"])
-        current_input_tpm = await self._get_window_sum(keys["input_tpm"])
-        current_output_tpm = await self._get_window_sum(keys["output_tpm"])
+        # 获取当前窗口及对应的 Redis 键
+        window_id, previous_weight = self._get_window(now)
+        keys = self._get_redis_keys(api_key, window_id)
         
-        # 创建速率限制信息
-        window_start, window_end = self._get_window_segments()
-        rate_limit_info = RateLimitInfo(
-            api_key=api_key,
-            input_tpm_used=current_input_tpm,
-            output_tpm_used=current_output_tpm,
-            rpm_used=current_rpm,
-            input_tpm_limit=limits["input_tpm"],
-            output_tpm_limit=limits["output_tpm"],
-            rpm_limit=limits["rpm"],
-            window_start=datetime.fromtimestamp(window_start * self.segment_size),
-            window_end=datetime.fromtimestamp((window_end + 1) * self.segment_size)
+        # 在 Redis 中一次性完成检查与计数
+        (allowed, current_rpm, current_input_tpm, current_output_tpm,
+         *window_counts) = await self._run_check_and_record(
+            keys,
+            previous_weight,
+            limits["rpm"],
+            limits["input_tpm"],
+            limits["output_tpm"],
+            input_tokens,
+            output_tokens,
+            self.window_size * 2  # 当前窗口的计数还要作为下一窗口的上一窗口使用
         )
         
-        # 检查是否超限
-        if current_rpm + 1 > limits["rpm"]:
-            return False, rate_limit_info
+        requests_retry_time = tokens_retry_time = None
+        if allowed != 1:
+            # 按两个窗口的原始计数推算超限维度最早能通过的时间
+            previous_counts, current_counts = window_counts[:3], window_counts[3:]
+            requests_retry_time, input_retry_time, output_retry_time = (
+                self._get_retry_time(window_id, previous_weight, previous, current, increment, limit)
+                for previous, current, increment, limit in zip(
+                    previous_counts,
+                    current_counts,
+                    (1, input_tokens, output_tokens),
+                    (limits["rpm"], limits["input_tpm"], limits["output_tpm"])
+                )
+            )
+            token_retry_times = [t for t in (input_retry_time, output_retry_time) if t is not None]
+            tokens_retry_time = max(token_retry_times) if token_retry_times else None
         
-        if current_input_tpm + input_tokens > limits["input_tpm"]:
-            return False, rate_limit_info
-        
-        if current_output_tpm + output_tokens > limits["output_tpm"]:
-            return False, rate_limit_info
+        # 创建速率限制信息
+        rate_limit_info = RateLimitState(
+            api_key,
+            current_input_tpm,
+            current_output_tpm,
+            current_rpm,
+            limits["input_tpm"],
+            limits["output_tpm"],
+            limits["rpm"],
+            (window_id + 2) * self.window_size,
+            requests_retry_time,
+            tokens_retry_time
+        )
         
-        return True, rate_limit_info
+        return allowed == 1, rate_limit_info, input_tokens
     
-    async def record_usage(self, api_key: str, input_tokens: int, output_tokens: int) -> None:
-        """记录使用量"""
-        current_segment = self._get_current_segment()
-        keys = self._get_redis_keys(api_key)
-        
-        # 使用管道批量执行
-        pipe = self.redis.pipeline()
-        
-        # 增加计数
-        pipe.hincrby(keys["rpm"], str(current_segment), 1)
-        pipe.hincrby(keys["input_tpm"], str(current_segment), input_tokens)
-        pipe.hincrby(keys["output_tpm"], str(current_segment), output_tokens)
-        
-        # 设置过期时间
-        expire_time = self.window_size * 2
-        pipe.expire(keys["rpm"], expire_time)
-        pipe.expire(keys["input_tpm"], expire_time)
-        pipe.expire(keys["output_tpm"], expire_time)
-        
-        await pipe.execute()
-        
-        # 异步清理旧数据（不阻塞主流程）
-        asyncio.create_task(self._clean_old_segments(keys["rpm"]))
-        asyncio.create_task(self._clean_old_segments(keys["input_tpm"]))
-        asyncio.create_task(self._clean_old_segments(keys["output_tpm"]))
-    
-    async def get_rate_limit_headers(self, api_key: str, rate_limit_info: RateLimitInfo) -> Dict[str, str]:
-        """生成速率限制响应头"""
-        reset_time = rate_limit_info.window_end
-        
-        headers = {
-            "X-RateLimit-Limit-Requests": str(rate_limit_info.rpm_limit),
-            "X-RateLimit-Limit-Tokens-Input": str(rate_limit_info.input_tpm_limit),
-            "X-RateLimit-Limit-Tokens-Output": str(rate_limit_info.output_tpm_limit),
-            "X-RateLimit-Remaining-Requests": str(max(0, rate_limit_info.rpm_limit - rate_limit_info.rpm_used)),
-            "X-RateLimit-Remaining-Tokens-Input": str(max(0, rate_limit_info.input_tpm_limit - rate_limit_info.input_tpm_used)),
-            "X-RateLimit-Remaining-Tokens-Output": str(max(0, rate_limit_info.output_tpm_limit - rate_limit_info.output_tpm_used)),
-            "X-RateLimit-Reset-Requests": reset_time.isoformat(),
-            "X-RateLimit-Reset-Tokens": reset_time.isoformat(),
-            "Retry-After": str(int((reset_time - datetime.now()).total_seconds()))
+    @staticmethod
+    def _build_static_headers(limits: Dict[str, int]) -> Dict[str, str]:
+        """生成只依赖限制配置的响应头"""
+        return {
+            "X-RateLimit-Limit-Requests": str(limits["rpm"]),
+            "X-RateLimit-Limit-Tokens-Input": str(limits["input_tpm"]),
+            "X-RateLimit-Limit-Tokens-Output": str(limits["output_tpm"])
         }
+    
+    async def get_rate_limit_headers(self, api_key: str, rate_limit_info: RateLimitState, now: float) -> Dict[str, str]:
+        """
+        生成速率限制响应头
+        超限的维度给出能容纳本次请求的最早时间，其余维度给出计数完全过期的时间
+        """
+        static_headers = self._static_headers.get(api_key)
+        if static_headers is None:
+            static_headers = self._build_static_headers(self.config.get_api_key_limits(api_key))
+        
+        reset_time = rate_limit_info.reset_time
+        cached_reset_time, reset_time_str = self._reset_time_cache
+        if cached_reset_time != reset_time:
+            reset_time_str = datetime.fromtimestamp(reset_time).isoformat()
+            self._reset_time_cache = (reset_time, reset_time_str)
+        
+        requests_retry_time = rate_limit_info.requests_retry_time
+        tokens_retry_time = rate_limit_info.tokens_retry_time
+        
+        headers = static_headers.copy()
+        headers["X-RateLimit-Remaining-Requests"] = str(max(0, rate_limit_info.rpm_limit - rate_limit_info.rpm_used))
+        headers["X-RateLimit-Remaining-Tokens-Input"] = str(max(0, rate_limit_info.input_tpm_limit - rate_limit_info.input_tpm_used))
+        headers["X-RateLimit-Remaining-Tokens-Output"] = str(max(0, rate_limit_info.output_tpm_limit - rate_limit_info.output_tpm_used))
+        headers["X-RateLimit-Reset-Requests"] = (
+            reset_time_str if requests_retry_time is None else datetime.fromtimestamp(requests_retry_time).isoformat()
+        )
+        headers["X-RateLimit-Reset-Tokens"] = (
+            reset_time_str if tokens_retry_time is None else datetime.fromtimestamp(tokens_retry_time).isoformat()
+        )
+        
+        retry_times = [t for t in (requests_retry_time, tokens_retry_time) if t is not None]
+        if retry_times:
+            # 被限流时，向上取整到整秒，保证按此重试时已能通过
+            headers["Retry-After"] = str(max(1, math.ceil(max(retry_times) - now)))
+        else:
+            headers["Retry-After"] = str(int(reset_time - now))
         
-        return headers 
\ No newline at end of file
+        return headers
\ No newline at end of file
@@ -3,13 +3,17 @@ FastAPI 服务器实现
 处理 OpenAI 格式的 API 请求并应用速率限制
 """
 import asyncio
+import os
 import random
 import time
 import sys
-from typing import Optional
-from fastapi import FastAPI, HTTPException, Header, Request
-from fastapi.responses import JSONResponse
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import Depends, FastAPI, HTTPException, Header, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response
+from pydantic import ValidationError
 import redis.asyncio as redis
+from redis.utils import HIREDIS_AVAILABLE
 import uvicorn
 
 from src.config import Config
@@ -19,11 +23,57 @@ from src.models import (
     ChatMessage,
     Choice,
     Usage,
-    ErrorResponse
+    ErrorResponse,
+    current_timestamp,
+    generate_completion_id
 )
 from src.rate_limiter import RateLimiter
 
 
+# Authorization 头前缀
+BEARER_PREFIX = "Bearer "
+
+# 限流错误响应体（内容固定，预先序列化）
+RATE_LIMIT_EXCEEDED_BODY = ErrorResponse(
+    error={
+        "message": "Rate limit exceeded",
+        "type": "rate_limit_exceeded",
+        "param": None,
+        "code": "rate_limit_exceeded"
+    }
+).model_dump_json()
+
+# mock 响应模板，{model} 会替换为请求的模型名
+MOCK_RESPONSE_TEMPLATES = [
+    "This is a mock response. Your request has been successfully processed.",
+    "I understand your request. This is a system-generated test response.",
+    "Processing complete. This is a mock response from the Rate Limiter system.",
+    "Message received. Currently using model: {model}.",
+    "This is an auto-generated response for testing rate limiting functionality."
+]
+
+# 按 max_tokens 追加的填充内容
+MOCK_RESPONSE_PADDING = " This is additional content to fill the response."
+
+
+async def parse_chat_completion_request(request: Request) -> ChatCompletionRequest:
+    """从原始请求体解析聊天补全请求（JSON 解析与校验一次完成）"""
+    try:
+        return ChatCompletionRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        # 交给 FastAPI 默认处理器，保持 422 响应格式不变
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        raise RequestValidationError(errors)
+
+
+def chat_completion_request_schemas() -> Dict[str, Dict[str, Any]]:
+    """生成 ChatCompletionRequest 及其嵌套模型的 JSON Schema（引用指向 OpenAPI components）"""
+    schema = ChatCompletionRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+    schemas = schema.pop("$defs", {})
+    schemas[ChatCompletionRequest.__name__] = schema
+    return schemas
+
+
 class RateLimiterServer:
     """Rate Limiter 服务器"""
     
@@ -31,39 +81,67 @@ class RateLimiterServer:
         self.app = FastAPI(title="LLM API Rate Limiter")
         self.config = Config()
         self.port = port
+        self._valid_api_keys = frozenset(self.config.API_KEY_LIMITS)
+        self.redis_pool = None
         self.redis_client = None
         self.rate_limiter = None
+        # (模板, 模板 token 数)，含模型名的模板 token 数为 None
+        self._mock_templates: List[Tuple[str, Optional[int]]] = []
+        self._mock_padding_tokens = 0
         
         # 设置路由
         self._setup_routes()
+        self._default_openapi = self.app.openapi
+        self.app.openapi = self._openapi
     
     async def startup(self):
         """启动事件"""
         # 连接 Redis
-        self.redis_client = await redis.from_url(
+        self.redis_pool = redis.ConnectionPool.from_url(
             f"redis://{self.config.REDIS_HOST}:{self.config.REDIS_PORT}/{self.config.REDIS_DB}",
             password=self.config.REDIS_PASSWORD,
-            decode_responses=True
+            decode_responses=True,
+            max_connections=self.config.REDIS_MAX_CONNECTIONS,
+            socket_keepalive=True,
+            health_check_interval=self.config.REDIS_HEALTH_CHECK_INTERVAL
         )
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
         
         # 测试 Redis 连接
         try:
             await self.redis_client.ping()
             print(f"[OK] Connected to Redis {self.config.REDIS_HOST}:{self.config.REDIS_PORT}")
+            if HIREDIS_AVAILABLE:
+                print("[INFO] Redis protocol parser: hiredis")
+            else:
+                print("[WARN] hiredis not installed, falling back to the pure Python parser")
         except Exception as e:
             print(f"[ERROR] Cannot connect to Redis: {e}")
             sys.exit(1)
         
         # 创建 Rate Limiter
         self.rate_limiter = RateLimiter(self.redis_client)
+        await self.rate_limiter.load_scripts()
+        self._prepare_mock_templates()
+        loop_type = type(asyncio.get_running_loop())
+        print(f"[INFO] Event loop: {loop_type.__module__}.{loop_type.__name__}")
         print(f"[INFO] Rate Limiter server started on port {self.port}")
     
     async def shutdown(self):
         """关闭事件"""
         if self.redis_client:
             await self.redis_client.close()
+        if self.redis_pool:
+            await self.redis_pool.disconnect()
         print("[INFO] Rate Limiter server stopped")
     
+    def _openapi(self) -> Dict[str, Any]:
+        """生成 OpenAPI 文档，并注册手动解析的请求体模型"""
+        if self.app.openapi_schema is None:
+            schema = self._default_openapi()
+            schema.setdefault("components", {}).setdefault("schemas", {}).update(chat_completion_request_schemas())
+        return self.app.openapi_schema
+    
     def _setup_routes(self):
         """设置路由"""
         self.app.add_event_handler("startup", self.startup)
@@ -74,96 +152,96 @@ class RateLimiterServer:
             """健康检查"""
             return {"status": "healthy", "service": "rate-limiter", "port": self.port}
         
-        @self.app.post("/v1/chat/completions")
+        # 请求体由依赖项手动解析，这里补回 OpenAPI 中的请求体定义（模型由 _openapi 注册到 components）
+        @self.app.post(
+            "/v1/chat/completions",
+            openapi_extra={
+                "requestBody": {
+                    "content": {"application/json": {"schema": {"$ref": "#/components/schemas/ChatCompletionRequest"}}},
+                    "required": True
+                }
+            }
+        )
         async def chat_completions(
-            request: ChatCompletionRequest,
+            request: ChatCompletionRequest = Depends(parse_chat_completion_request),
             authorization: Optional[str] = Header(None)
         ):
             """处理聊天补全请求"""
+            # 整个请求只读取一次时钟
+            now = time.time()
+            
             # 提取 API Key
-            if not authorization or not authorization.startswith("Bearer "):
+            if not authorization or not authorization.startswith(BEARER_PREFIX):
                 raise HTTPException(
                     status_code=401,
                     detail={"error": {"message": "Invalid authorization header", "type": "invalid_request_error"}}
                 )
             
-            api_key = authorization.replace("Bearer ", "")
+            api_key = authorization[len(BEARER_PREFIX):]
             
             # 检查 API Key 是否有效
-            if api_key not in self.config.API_KEY_LIMITS:
+            if api_key not in self._valid_api_keys:
                 raise HTTPException(
                     status_code=401,
                     detail={"error": {"message": "Invalid API key", "type": "invalid_request_error"}}
                 )
             
-            # 检查速率限制
-            allowed, rate_limit_info = await self.rate_limiter.check_rate_limit(api_key, request)
+            # 检查速率限制并记录使用量
+            allowed, rate_limit_info, input_tokens = await self.rate_limiter.check_and_record(api_key, request, now)
             
             # 生成响应头
-            headers = await self.rate_limiter.get_rate_limit_headers(api_key, rate_limit_info)
+            headers = await self.rate_limiter.get_rate_limit_headers(api_key, rate_limit_info, now)
             
             if not allowed:
                 # 返回 429 错误
-                return JSONResponse(
+                return Response(
                     status_code=429,
                     headers=headers,
-                    content={
-                        "error": {
-                            "message": "Rate limit exceeded",
-                            "type": "rate_limit_exceeded",
-                            "param": None,
-                            "code": "rate_limit_exceeded"
-                        }
-                    }
+                    content=RATE_LIMIT_EXCEEDED_BODY,
+                    media_type="application/json"
                 )
             
             # 生成 mock 响应
-            mock_response = await self._generate_mock_response(request)
+            mock_response = await self._generate_mock_response(request, input_tokens)
             
-            # 记录使用量
-            await self.rate_limiter.record_usage(
-                api_key,
-                mock_response.usage.prompt_tokens,
-                mock_response.usage.completion_tokens
-            )
-            
-            # 返回响应
-            return JSONResponse(
+            # 返回响应（由 pydantic 直接序列化为 JSON）
+            return Response(
                 status_code=200,
                 headers=headers,
-                content=mock_response.model_dump()
+                content=mock_response.model_dump_json(exclude_none=True),
+                media_type="application/json"
             )
     
-    async def _generate_mock_response(self, request: ChatCompletionRequest) -> ChatCompletionResponse:
+    async def _generate_mock_response(self, request: ChatCompletionRequest, prompt_tokens: int) -> ChatCompletionResponse:
         """生成 mock OpenAI API 响应"""
         # 模拟处理延迟
-        delay = random.uniform(
-            self.config.MOCK_RESPONSE_DELAY_MIN,
-            self.config.MOCK_RESPONSE_DELAY_MAX
-        )
-        await asyncio.sleep(delay)
-        
-        # 计算 token 数量
-        prompt_tokens = self.rate_limiter.estimate_request_tokens(request)
+        if self.config.MOCK_RESPONSE_ENABLE_DELAY:
+            delay = random.uniform(
+                self.config.MOCK_RESPONSE_DELAY_MIN,
+                self.config.MOCK_RESPONSE_DELAY_MAX
+            )
+            await asyncio.sleep(delay)
         
         # 生成 mock 响应内容
-        mock_content = self._generate_mock_content(request)
-        completion_tokens = self.rate_limiter.count_tokens(mock_content)
+        mock_content, completion_tokens = self._generate_mock_content(request)
         
-        # 创建响应
-        response = ChatCompletionResponse(
+        # 创建响应（字段均由服务端生成，跳过校验；显式传入默认字段以保持字段顺序）
+        response = ChatCompletionResponse.model_construct(
+            id=generate_completion_id(),
+            object="chat.completion",
+            created=current_timestamp(),
             model=request.model,
             choices=[
-                Choice(
+                Choice.model_construct(
                     index=0,
-                    message=ChatMessage(
+                    message=ChatMessage.model_construct(
                         role="assistant",
                         content=mock_content
                     ),
                     finish_reason="stop"
                 )
             ],
-            usage=Usage(
+            usage=Usage.model_construct(
                 prompt_tokens=prompt_tokens,
                 completion_tokens=completion_tokens,
                 total_tokens=prompt_tokens + completion_tokens
@@ -173,47 +251,75 @@ class RateLimiterServer:
         
         return response
     
-    def _generate_mock_content(self, request: ChatCompletionRequest) -> str:
-        """生成 mock 响应内容"""
-        # 简单的 mock 响应生成
-        templates = [
-            "This is a mock response. Your request has been successfully processed.",
-            "I understand your request. This is a system-generated test response.",
-            "Processing complete. This is a mock response from the Rate Limiter system.",
-            f"Message received. Currently using model: {request.model}.",
-            "This is an auto-generated response for testing rate limiting functionality."
+    def _prepare_mock_templates(self):
+        """预先计算 mock 模板和填充内容的 token 数"""
+        count_tokens = self.rate_limiter.count_tokens
+        self._mock_templates = [
+            (template, None if "{model}" in template else count_tokens(template))
+            for template in MOCK_RESPONSE_TEMPLATES
         ]
-        
+        self._mock_padding_tokens = count_tokens(MOCK_RESPONSE_PADDING)
+    
+    def _generate_mock_content(self, request: ChatCompletionRequest) -> Tuple[str, int]:
+        """生成 mock 响应内容，返回 (内容, token 数)"""
         # 随机选择一个模板
-        base_content = random.choice(templates)
+        template, content_tokens = random.choice(self._mock_templates)
+        if content_tokens is None:
+            base_content = template.format(model=request.model)
+            content_tokens = self.rate_limiter.count_tokens(base_content)
+        else:
+            base_content = template
         
         # 如果设置了 max_tokens，生成相应长度的内容
+        # 模板以句号结尾、填充以空格开头，分词边界不会跨越拼接处，token 数可直接相加
         if request.max_tokens and request.max_tokens > 50:
-            additional_content = " This is additional content to fill the response." * (request.max_tokens // 20)
-            base_content += additional_content
+            repeat = request.max_tokens // 20
+            base_content += MOCK_RESPONSE_PADDING * repeat
+            content_tokens += self._mock_padding_tokens * repeat
         
-        return base_content
+        return base_content, content_tokens
     
-    def run(self):
+    def run(self, workers: int = 1):
         """运行服务器"""
+        if workers > 1:
+            # 多 worker 共享同一端口，各 worker 进程通过 app_factory 创建自己的应用
+            os.environ["SERVER_PORT"] = str(self.port)
+            uvicorn.run(
+                "src.server:app_factory",
+                factory=True,
+                host=self.config.SERVER_HOST,
+                port=self.port,
+                workers=workers,
+                loop="auto",
+                log_level="info"
+            )
+            return
+        
         uvicorn.run(
             self.app,
             host=self.config.SERVER_HOST,
             port=self.port,
+            loop="auto",  # 已安装 uvloop 时自动使用
             log_level="info"
         )
 
 
+def app_factory() -> FastAPI:
+    """创建应用（供 uvicorn 多 worker 模式导入）"""
+    return RateLimiterServer(port=Config.SERVER_PORT).app
+
+
 def main():
     """主函数"""
     import argparse
     
     parser = argparse.ArgumentParser(description="LLM API Rate Limiter Server")
     parser.add_argument("--port", type=int, default=8000, help="Server port")
+    parser.add_argument("--workers", type=int, default=Config.SERVER_WORKERS, help="Worker processes")
     args = parser.parse_args()
     
     server = RateLimiterServer(port=args.port)
-    server.run()
+    server.run(workers=args.workers)
 
 
 if __name__ == "__main__":
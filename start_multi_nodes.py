@@ -1,6 +1,7 @@
 """
 多节点启动脚本
-用于启动多个 Rate Limiter 服务实例
+用于在多个端口上启动 Rate Limiter 服务实例（开发环境模拟多节点）
+单端口部署可直接使用: python -m src.server --port 8000 --workers N
 """
 import subprocess
 import sys
@@ -17,6 +18,7 @@ class MultiNodeManager:
     def __init__(self):
         self.processes: List[subprocess.Popen] = []
         self.ports = [8000, 8001, 8002]  # 默认端口
+        self.workers = 1  # 每个节点的 worker 进程数
         
     def read_output(self, process, port):
         """读取进程输出的线程函数"""
@@ -38,7 +40,7 @@ class MultiNodeManager:
         
         # 启动进程
         process = subprocess.Popen(
-            [sys.executable, "-m", "src.server", "--port", str(port)],
+            [sys.executable, "-m", "src.server", "--port", str(port), "--workers", str(self.workers)],
             env=env,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -142,6 +144,8 @@ def main():
     parser = argparse.ArgumentParser(description="启动多个 Rate Limiter 节点")
     parser.add_argument("--ports", nargs="+", type=int, default=[8000, 8001, 8002],
                        help="节点端口列表")
+    parser.add_argument("--workers", type=int, default=1,
+                       help="每个节点的 worker 进程数")
     parser.add_argument("--skip-redis-check", action="store_true",
                        help="跳过 Redis 检查")
     
@@ -154,6 +158,7 @@ def main():
     # 创建并运行管理器
     manager = MultiNodeManager()
     manager.ports = args.ports
+    manager.workers = args.workers
     manager.run()
 
 
@@ -90,6 +90,44 @@ def test_api_request(port=8000):
         return False
 
 
+def _collect_refs(node):
+    """递归收集 JSON 文档中的全部 $ref"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "$ref":
+                yield value
+            else:
+                yield from _collect_refs(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _collect_refs(value)
+
+
+def test_openapi_schema(port=8000):
+    """测试 OpenAPI 文档中的 $ref 均可解析"""
+    print("\n📄 测试 OpenAPI 文档...")
+    try:
+        schema = requests.get(f"http://localhost:{port}/openapi.json").json()
+    except Exception as e:
+        print(f"❌ 无法获取 OpenAPI 文档: {e}")
+        return False
+    
+    unresolved = []
+    for ref in sorted(set(_collect_refs(schema))):
+        node = schema
+        for part in ref.split("/")[1:]:
+            if not isinstance(node, dict) or part not in node:
+                unresolved.append(ref)
+                break
+            node = node[part]
+    
+    if unresolved:
+        print(f"❌ 无法解析的 $ref: {unresolved}")
+        return False
+    print("✅ OpenAPI 文档中的 $ref 均可解析")
+    return True
+
+
 def main():
     """主测试函数"""
     print("=" * 60)
@@ -115,6 +153,11 @@ def main():
             print("\n❌ 测试失败：API 请求失败")
             return
         
+        # 测试 OpenAPI 文档
+        if not test_openapi_schema(8888):
+            print("\n❌ 测试失败：OpenAPI 文档不完整")
+            return
+        
         print("\n" + "=" * 60)
         print("✅ 所有测试通过！系统运行正常。")
         print("=" * 60)
@@ -2,18 +2,114 @@
 测试客户端 - 模拟生成 OpenAI API 请求
 """
 import asyncio
-import random
+import bisect
+import sys
 import time
-import json
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from datetime import datetime
 import httpx
+import orjson
 from dataclasses import dataclass, field
 import argparse
-import statistics
+import numpy as np
 
 
-@dataclass
+# 可选的 max_tokens 取值
+MAX_TOKENS_CHOICES = [None, 100, 500, 1000, 2000]
+
+# 消息角色按下标奇偶交替；消息数只取奇数，最后一条总是用户消息
+# 消息数分布与原先 1~3 条、偶数条补一条用户消息时相同：1 条占 1/3，3 条占 2/3
+ROLES = ("user", "assistant")
+NUM_MESSAGES_CHOICES = (1, 3)
+NUM_MESSAGES_WEIGHTS = (1 / 3, 2 / 3)
+MAX_MESSAGES = 3
+
+# 额外内容：以一定概率在消息后追加若干句
+EXTRA_SENTENCE = "这是额外的内容。"
+EXTRA_PROBABILITY = 0.3
+EXTRA_LEN_MIN = 5
+EXTRA_LEN_MAX = 20
+
+# 每批预生成的随机样本数
+SAMPLE_BATCH_SIZE = 4096
+
+# 流式分位数模式下，样本数不超过该值时保留原始样本并精确计算分位数
+# （P² 的标记需要足够多的样本才能收敛到高分位数）
+STREAMING_EXACT_SAMPLES = 512
+
+# 请求日志格式，由后台任务在输出时格式化
+LOG_OK = "✅ 成功 | API Key: {} | 响应时间: {:.2f}s"
+LOG_RATE_LIMITED = "⚠️  限流 | API Key: {} | {} RPM"
+LOG_FAILED = "❌ 失败 | API Key: {} | 状态码: {}"
+LOG_ERROR = "❌ 错误 | API Key: {} | 错误: {}"
+
+# 日志队列容量与每次输出的最大条数
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 100
+
+
+class P2Quantile:
+    """
+    P² 流式分位数估计（Jain & Chlamtac, 1985）
+    只维护 5 个标记的高度和位置，每个样本 O(1) 更新，内存占用固定
+    """
+    __slots__ = ("p", "_heights", "_positions", "_desired", "_increments")
+    
+    def __init__(self, p: float):
+        self.p = p
+        self._heights: List[float] = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+        self._increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+    
+    def add(self, x: float) -> None:
+        """加入一个样本"""
+        q = self._heights
+        if len(q) < 5:
+            bisect.insort(q, x)
+            return
+        
+        # 找到样本所在的区间，必要时扩展两端标记
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q, x) - 1
+        
+        n = self._positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        d = self._desired
+        for i in range(5):
+            d[i] += self._increments[i]
+        
+        # 中间标记偏离期望位置时，用抛物线（或线性）插值调整高度
+        for i in (1, 2, 3):
+            delta = d[i] - n[i]
+            if (delta >= 1 and n[i + 1] - n[i] > 1) or (delta <= -1 and n[i - 1] - n[i] < -1):
+                s = 1 if delta > 0 else -1
+                height = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                q[i] = height
+                n[i] += s
+    
+    def value(self) -> float:
+        """当前的分位数估计值"""
+        q = self._heights
+        if len(q) < 5:
+            # 样本不足 5 个时直接计算
+            return float(np.percentile(q, self.p * 100)) if q else 0.0
+        return q[2]
+
+
+@dataclass(slots=True)
 class RequestStats:
     """请求统计信息"""
     total_requests: int = 0
@@ -22,38 +118,116 @@ class RequestStats:
     failed_requests: int = 0
     total_input_tokens: int = 0
     total_output_tokens: int = 0
-    response_times: List[float] = field(default_factory=list)
     start_time: float = field(default_factory=time.time)
+    # 为 True 时用 P² 估计分位数，不保存每个响应时间（适合长时间运行）
+    streaming_quantiles: bool = False
+    # 计算测试时长用的单调时钟起点
+    _start_counter: float = field(default_factory=time.perf_counter, init=False, repr=False)
+    # 响应时间样本（纳秒）：预分配的连续缓冲区及已写入数量
+    _rt_buf: np.ndarray = field(default_factory=lambda: np.empty(1024, dtype=np.int64), init=False, repr=False)
+    _rt_n: int = field(default=0, init=False, repr=False)
+    # 流式模式下的 P50/P95/P99 估计器及响应时间总和（纳秒）
+    _quantiles: Optional[Tuple[P2Quantile, ...]] = field(default=None, init=False, repr=False)
+    _rt_sum: int = field(default=0, init=False, repr=False)
+    
+    def __post_init__(self) -> None:
+        if self.streaming_quantiles:
+            self._quantiles = (P2Quantile(0.50), P2Quantile(0.95), P2Quantile(0.99))
+            self._rt_buf = np.empty(STREAMING_EXACT_SAMPLES, dtype=np.int64)
+    
+    @property
+    def response_times(self) -> np.ndarray:
+        """已记录的响应时间（秒），流式模式下只包含前 STREAMING_EXACT_SAMPLES 个"""
+        return self._rt_buf[:self._rt_n] * 1e-9
+    
+    def record_response_time(self, response_time_ns: int) -> None:
+        """记录一次响应时间（纳秒），缓冲区写满时容量翻倍"""
+        if self._quantiles is not None:
+            if self._rt_n < STREAMING_EXACT_SAMPLES:
+                self._rt_buf[self._rt_n] = response_time_ns
+            for quantile in self._quantiles:
+                quantile.add(response_time_ns)
+            self._rt_sum += response_time_ns
+            self._rt_n += 1
+            return
+        
+        if self._rt_n == len(self._rt_buf):
+            grown = np.empty(len(self._rt_buf) * 2, dtype=np.int64)
+            grown[:self._rt_n] = self._rt_buf
+            self._rt_buf = grown
+        self._rt_buf[self._rt_n] = response_time_ns
+        self._rt_n += 1
     
     def get_summary(self) -> Dict[str, Any]:
         """获取统计摘要"""
-        elapsed_time = time.time() - self.start_time
+        elapsed_time = time.perf_counter() - self._start_counter
+        
+        # 响应时间以纳秒记录，最后统一换算为秒
+        response_times_ns = self._rt_buf[:self._rt_n]
+        if self._quantiles is not None and self._rt_n > STREAMING_EXACT_SAMPLES:
+            avg_response_time = self._rt_sum / self._rt_n * 1e-9
+            p50, p95, p99 = (quantile.value() * 1e-9 for quantile in self._quantiles)
+        elif response_times_ns.size:
+            # 一次排序同时得到全部分位数
+            avg_response_time = float(response_times_ns.mean()) * 1e-9
+            p50, p95, p99 = (np.percentile(response_times_ns, [50, 95, 99]) * 1e-9).tolist()
+        else:
+            avg_response_time = p50 = p95 = p99 = 0.0
+        
+        total = self.total_requests
         
         return {
+            "start_time": datetime.fromtimestamp(self.start_time).isoformat(sep=" ", timespec="seconds"),
             "duration_seconds": elapsed_time,
-            "total_requests": self.total_requests,
+            "total_requests": total,
             "successful_requests": self.successful_requests,
             "rate_limited_requests": self.rate_limited_requests,
             "failed_requests": self.failed_requests,
-            "requests_per_second": self.total_requests / elapsed_time if elapsed_time > 0 else 0,
-            "success_rate": self.successful_requests / self.total_requests if self.total_requests > 0 else 0,
-            "rate_limit_rate": self.rate_limited_requests / self.total_requests if self.total_requests > 0 else 0,
+            "requests_per_second": total / elapsed_time if elapsed_time > 0 else 0,
+            "success_rate": self.successful_requests / total if total > 0 else 0,
+            "rate_limit_rate": self.rate_limited_requests / total if total > 0 else 0,
             "total_input_tokens": self.total_input_tokens,
             "total_output_tokens": self.total_output_tokens,
-            "avg_response_time": statistics.mean(self.response_times) if self.response_times else 0,
-            "p50_response_time": statistics.median(self.response_times) if self.response_times else 0,
-            "p95_response_time": statistics.quantiles(self.response_times, n=20)[18] if len(self.response_times) > 20 else 0,
-            "p99_response_time": statistics.quantiles(self.response_times, n=100)[98] if len(self.response_times) > 100 else 0,
+            "avg_response_time": avg_response_time,
+            "p50_response_time": p50,
+            "p95_response_time": p95,
+            "p99_response_time": p99,
         }
 
 
 class TestClient:
     """OpenAI API 测试客户端"""
     
-    def __init__(self, server_urls: List[str], api_keys: List[str]):
+    def __init__(self, server_urls: List[str], api_keys: List[str], concurrency: int = 10,
+                 quiet: bool = False, streaming_quantiles: bool = False):
         self.server_urls = server_urls
+        # 各服务器的完整请求地址只拼接一次
+        self._endpoints = [url.rstrip("/") + "/v1/chat/completions" for url in server_urls]
         self.api_keys = api_keys
-        self.stats = RequestStats()
+        self.stats = RequestStats(streaming_quantiles=streaming_quantiles)
+        
+        # 各 API Key 的请求头只构造一次
+        self._headers_by_key = {
+            api_key: {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            }
+            for api_key in api_keys
+        }
+        
+        # 整个测试共用一个 HTTP 客户端，保持长连接
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=concurrency * 2,
+                max_keepalive_connections=concurrency
+            ),
+            timeout=httpx.Timeout(30.0)
+        )
+        
+        # 请求日志经队列交给后台任务输出，quiet 模式下不记录
+        self._verbose = not quiet
+        self._log_queue: Optional[asyncio.Queue] = asyncio.Queue(maxsize=LOG_QUEUE_SIZE) if self._verbose else None
+        self._log_task: Optional[asyncio.Task] = None
         
         # 预定义的消息模板
         self.message_templates = [
@@ -70,88 +244,236 @@ class TestClient:
         ]
         
         self.models = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo"]
-    
-    def generate_request(self) -> Dict[str, Any]:
-        """生成随机的 OpenAI API 请求"""
-        messages = []
         
-        # 随机生成 1-3 条消息
-        num_messages = random.randint(1, 3)
-        for i in range(num_messages):
-            role = "user" if i % 2 == 0 else "assistant"
-            content = random.choice(self.message_templates)
-            
-            # 随机增加消息长度
-            if random.random() < 0.3:
-                content += " " + " ".join(["这是额外的内容。"] * random.randint(5, 20))
-            
-            messages.append({
-                "role": role,
-                "content": content
-            })
-        
-        # 确保最后一条消息是用户消息
-        if messages[-1]["role"] != "user":
-            messages.append({
-                "role": "user",
-                "content": random.choice(self.message_templates)
-            })
-        
-        request = {
-            "model": random.choice(self.models),
-            "messages": messages,
-            "temperature": random.uniform(0.5, 1.0),
-            "max_tokens": random.choice([None, 100, 500, 1000, 2000])
+        # 模板和模型在启动后不再变化，预先生成请求构造函数
+        self._make_req = self._compile_request_builder()
+        
+        # 预生成的随机样本（每个字段一个列表，按样本下标访问）
+        self._rng = np.random.default_rng()
+        self._samples: Dict[str, List[Any]] = {}
+        self._sample_size = 0
+        self._sample_pos = 0
+    
+    def _presample(self, n: int) -> None:
+        """用 numpy 一次性生成 n 个请求所需的全部随机数"""
+        rng = self._rng
+        self._samples = {
+            "num_messages": rng.choice(NUM_MESSAGES_CHOICES, size=n, p=NUM_MESSAGES_WEIGHTS).tolist(),
+            "templates": rng.integers(0, len(self.message_templates), size=(n, MAX_MESSAGES)).tolist(),
+            "extra_len": self._sample_extra_len(n),
+            "temperature": rng.uniform(0.5, 1.0, size=n).tolist(),
+            "model": rng.integers(0, len(self.models), size=n).tolist(),
+            "max_tokens": rng.integers(0, len(MAX_TOKENS_CHOICES), size=n).tolist(),
+            "server": rng.integers(0, len(self.server_urls), size=n).tolist(),
+            "api_key": rng.integers(0, len(self.api_keys), size=n).tolist()
         }
+        self._sample_size = n
+        self._sample_pos = 0
+    
+    def _sample_extra_len(self, n: int) -> List[List[int]]:
+        """生成每条消息追加的额外内容段数（0 表示不追加）"""
+        rng = self._rng
+        extra_len = rng.integers(EXTRA_LEN_MIN, EXTRA_LEN_MAX + 1, size=(n, MAX_MESSAGES))
+        extra_len[rng.random((n, MAX_MESSAGES)) >= EXTRA_PROBABILITY] = 0
+        return extra_len.tolist()
+    
+    def _next_sample(self) -> int:
+        """获取下一个样本下标，样本用完时重新批量生成"""
+        if self._sample_pos == self._sample_size:
+            self._presample(SAMPLE_BATCH_SIZE)
+        i = self._sample_pos
+        self._sample_pos += 1
+        return i
+    
+    async def aclose(self) -> None:
+        """关闭 HTTP 客户端"""
+        await self._client.aclose()
+    
+    async def __aenter__(self) -> "TestClient":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+    
+    def _log(self, fmt: str, *args: Any) -> None:
+        """
+        记录一条请求日志（只入队，不在请求路径上输出）
+        参数原样入队，由后台任务格式化；调用方应先检查 self._verbose 再准备参数
+        """
+        try:
+            self._log_queue.put_nowait((fmt, args))
+        except asyncio.QueueFull:
+            pass  # 日志积压时丢弃，不阻塞请求
+    
+    @staticmethod
+    def _write_logs(entries: List[Tuple[str, Tuple[Any, ...]]]) -> None:
+        """格式化并一次性输出一批日志"""
+        sys.stdout.write("".join(fmt.format(*args) + "\n" for fmt, args in entries))
+    
+    async def _drain_logs(self) -> None:
+        """后台任务：批量输出请求日志"""
+        queue = self._log_queue
+        while True:
+            entries = [await queue.get()]
+            while len(entries) < LOG_BATCH_SIZE and not queue.empty():
+                entries.append(queue.get_nowait())
+            self._write_logs(entries)
+    
+    def _start_logging(self) -> None:
+        """启动日志输出任务"""
+        if self._log_queue is not None:
+            self._log_task = asyncio.create_task(self._drain_logs())
+    
+    async def _stop_logging(self) -> None:
+        """停止日志输出任务并输出剩余日志"""
+        if self._log_task is None:
+            return
+        self._log_task.cancel()
+        try:
+            await self._log_task
+        except asyncio.CancelledError:
+            pass
+        self._log_task = None
         
-        return request
+        entries = []
+        while not self._log_queue.empty():
+            entries.append(self._log_queue.get_nowait())
+        if entries:
+            self._write_logs(entries)
     
-    async def send_request(self, client: httpx.AsyncClient, request_data: Dict[str, Any]) -> None:
-        """发送单个请求"""
-        # 随机选择服务器和 API Key
-        server_url = random.choice(self.server_urls)
-        api_key = random.choice(self.api_keys)
+    def _compile_request_builder(self):
+        """预先展开消息内容，返回只做查表的请求构造函数"""
+        # contents[t][n]: 第 t 个模板追加 n 段额外内容后的文本
+        contents = [
+            [template] + [
+                template + " " + " ".join([EXTRA_SENTENCE] * n)
+                for n in range(1, EXTRA_LEN_MAX + 1)
+            ]
+            for template in self.message_templates
+        ]
+        models = self.models
+        max_tokens_choices = MAX_TOKENS_CHOICES
+        roles = ROLES
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+        def make_req(num_messages: int, templates: List[int], extra_len: List[int],
+                     temperature: float, model: int, max_tokens: int) -> Dict[str, Any]:
+            return {
+                "model": models[model],
+                "messages": [
+                    {"role": roles[j & 1], "content": contents[templates[j]][extra_len[j]]}
+                    for j in range(num_messages)
+                ],
+                "temperature": temperature,
+                "max_tokens": max_tokens_choices[max_tokens]
+            }
         
-        start_time = time.time()
+        return make_req
+    
+    def generate_request(self, i: int) -> Dict[str, Any]:
+        """根据第 i 个预生成样本构造 OpenAI API 请求"""
+        samples = self._samples
+        return self._make_req(
+            samples["num_messages"][i],
+            samples["templates"][i],
+            samples["extra_len"][i],
+            samples["temperature"][i],
+            samples["model"][i],
+            samples["max_tokens"][i]
+        )
+    
+    def _prepare_request(self) -> Tuple[Dict[str, Any], str, str]:
+        """
+        取下一个样本，返回 (请求数据, 请求地址, API Key)
+        必须在创建任务前同步调用：样本批次可能在任务运行前被替换
+        """
+        i = self._next_sample()
+        samples = self._samples
+        return (
+            self.generate_request(i),
+            self._endpoints[samples["server"][i]],
+            self.api_keys[samples["api_key"][i]]
+        )
+    
+    async def send_request(self, client: httpx.AsyncClient, request_data: Dict[str, Any],
+                           endpoint: str, api_key: str) -> None:
+        """发送单个请求"""
+        # 请求体用 orjson 预先编码
+        body = orjson.dumps(request_data)
+        stats = self.stats
+        
+        start_ns = time.perf_counter_ns()
         
         try:
             response = await client.post(
-                f"{server_url}/v1/chat/completions",
-                json=request_data,
-                headers=headers,
+                endpoint,
+                content=body,
+                headers=self._headers_by_key[api_key],
                 timeout=30.0
             )
             
-            response_time = time.time() - start_time
-            self.stats.response_times.append(response_time)
-            self.stats.total_requests += 1
+            response_time_ns = time.perf_counter_ns() - start_ns
+            stats.record_response_time(response_time_ns)
+            stats.total_requests += 1
             
             if response.status_code == 200:
-                self.stats.successful_requests += 1
-                data = response.json()
-                if "usage" in data:
-                    self.stats.total_input_tokens += data["usage"]["prompt_tokens"]
-                    self.stats.total_output_tokens += data["usage"]["completion_tokens"]
+                stats.successful_requests += 1
+                usage = orjson.loads(response.content).get("usage")
+                if usage:
+                    stats.total_input_tokens += usage["prompt_tokens"]
+                    stats.total_output_tokens += usage["completion_tokens"]
                 
-                print(f"✅ 成功 | API Key: {api_key} | 响应时间: {response_time:.2f}s")
+                if self._verbose:
+                    self._log(LOG_OK, api_key, response_time_ns * 1e-9)
             
             elif response.status_code == 429:
-                self.stats.rate_limited_requests += 1
-                print(f"⚠️  限流 | API Key: {api_key} | {response.headers.get('X-RateLimit-Limit-Requests', 'N/A')} RPM")
+                stats.rate_limited_requests += 1
+                if self._verbose:
+                    self._log(LOG_RATE_LIMITED, api_key, response.headers.get('X-RateLimit-Limit-Requests', 'N/A'))
             
             else:
-                self.stats.failed_requests += 1
-                print(f"❌ 失败 | API Key: {api_key} | 状态码: {response.status_code}")
+                stats.failed_requests += 1
+                if self._verbose:
+                    self._log(LOG_FAILED, api_key, response.status_code)
         
         except Exception as e:
-            self.stats.failed_requests += 1
-            self.stats.total_requests += 1
-            print(f"❌ 错误 | API Key: {api_key} | 错误: {str(e)}")
+            stats.failed_requests += 1
+            stats.total_requests += 1
+            if self._verbose:
+                # 异常对象原样入队，str(e) 延迟到输出时
+                self._log(LOG_ERROR, api_key, e)
+    
+    async def _run_requests(self, concurrency: int, should_continue: Callable[[int], bool]) -> None:
+        """
+        保持最多 concurrency 个请求在途，有请求完成就立即补发，
+        直到 should_continue(已发出请求数) 返回 False
+        """
+        self._start_logging()
+        try:
+            client = self._client
+            semaphore = asyncio.Semaphore(concurrency)
+            # 只保留在途任务，内存占用与并发数成正比
+            tasks = set()
+            request_count = 0
+            
+            async def send_one(request_data: Dict[str, Any], endpoint: str, api_key: str):
+                try:
+                    await self.send_request(client, request_data, endpoint, api_key)
+                finally:
+                    semaphore.release()
+            
+            while True:
+                await semaphore.acquire()
+                if not should_continue(request_count):
+                    semaphore.release()
+                    break
+                task = asyncio.create_task(send_one(*self._prepare_request()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                request_count += 1
+            
+            await asyncio.gather(*tasks)
+        finally:
+            await self._stop_logging()
     
     async def run_concurrent_requests(self, num_requests: int, concurrency: int) -> None:
         """并发运行多个请求"""
@@ -159,19 +481,21 @@ class TestClient:
         print(f"📡 服务器: {self.server_urls}")
         print(f"🔑 API Keys: {self.api_keys}\n")
         
-        async with httpx.AsyncClient() as client:
-            semaphore = asyncio.Semaphore(concurrency)
-            
-            async def send_with_limit():
-                async with semaphore:
-                    request_data = self.generate_request()
-                    await self.send_request(client, request_data)
-            
-            # 创建所有任务
-            tasks = [send_with_limit() for _ in range(num_requests)]
-            
-            # 并发执行
-            await asyncio.gather(*tasks)
+        # 预先生成本轮请求的随机数，不足时按批补充
+        self._presample(min(num_requests, SAMPLE_BATCH_SIZE))
+        
+        await self._run_requests(concurrency, lambda sent: sent < num_requests)
+    
+    async def run_for_duration(self, duration: float, concurrency: int) -> None:
+        """在指定时间内持续保持 concurrency 个请求在途"""
+        print(f"\n🚀 开始测试: 持续 {duration} 秒，并发数: {concurrency}")
+        print(f"📡 服务器: {self.server_urls}")
+        print(f"🔑 API Keys: {self.api_keys}\n")
+        
+        self._presample(SAMPLE_BATCH_SIZE)
+        
+        deadline = time.perf_counter() + duration
+        await self._run_requests(concurrency, lambda sent: time.perf_counter() < deadline)
     
     def print_stats(self) -> None:
         """打印统计信息"""
@@ -181,7 +505,8 @@ class TestClient:
         print("📊 测试统计报告")
         print("="*60)
         
-        print(f"\n⏱️  测试时长: {summary['duration_seconds']:.2f} 秒")
+        print(f"\n🕐 开始时间: {summary['start_time']}")
+        print(f"⏱️  测试时长: {summary['duration_seconds']:.2f} 秒")
         print(f"📨 总请求数: {summary['total_requests']}")
         print(f"✅ 成功请求: {summary['successful_requests']} ({summary['success_rate']:.1%})")
         print(f"⚠️  限流请求: {summary['rate_limited_requests']} ({summary['rate_limit_rate']:.1%})")
@@ -192,7 +517,7 @@ class TestClient:
         print(f"📤 总输出 Token: {summary['total_output_tokens']:,}")
         
         if summary['avg_response_time'] > 0:
-            print(f"\n⏱️  响应时间统计:")
+            print("\n⏱️  响应时间统计:")
             print(f"   • 平均: {summary['avg_response_time']:.3f} 秒")
             print(f"   • P50: {summary['p50_response_time']:.3f} 秒")
             print(f"   • P95: {summary['p95_response_time']:.3f} 秒")
@@ -211,30 +536,39 @@ async def main():
     parser.add_argument("--requests", type=int, default=100, help="总请求数")
     parser.add_argument("--concurrency", type=int, default=10, help="并发数")
     parser.add_argument("--duration", type=int, help="测试持续时间（秒），如果设置则忽略 --requests")
+    parser.add_argument("--quiet", action="store_true", help="不输出单个请求的日志（用于压测）")
+    parser.add_argument("--streaming-quantiles", action="store_true",
+                       help="用流式估计计算响应时间分位数，不保存全部样本（用于长时间测试）")
     
     args = parser.parse_args()
     
     # 创建测试客户端
-    client = TestClient(args.servers, args.api_keys)
-    
-    if args.duration:
-        # 基于时间的测试
-        print(f"⏰ 运行 {args.duration} 秒的负载测试...")
-        start_time = time.time()
-        request_count = 0
-        
-        while time.time() - start_time < args.duration:
-            await client.run_concurrent_requests(args.concurrency, args.concurrency)
-            request_count += args.concurrency
+    async with TestClient(args.servers, args.api_keys, concurrency=args.concurrency,
+                          quiet=args.quiet, streaming_quantiles=args.streaming_quantiles) as client:
+        if args.duration:
+            # 基于时间的测试
+            print(f"⏰ 运行 {args.duration} 秒的负载测试...")
+            start = time.perf_counter()
+            await client.run_for_duration(args.duration, args.concurrency)
+            elapsed = time.perf_counter() - start
+            
+            # 以实际完成的请求数和实际耗时为准
+            completed = client.stats.total_requests
+            print(f"\n📊 在 {elapsed:.2f} 秒内完成了 {completed} 个请求")
+        else:
+            # 基于请求数的测试
+            await client.run_concurrent_requests(args.requests, args.concurrency)
         
-        print(f"\n📊 在 {args.duration} 秒内发送了 {request_count} 个请求")
-    else:
-        # 基于请求数的测试
-        await client.run_concurrent_requests(args.requests, args.concurrency)
-    
-    # 打印统计信息
-    client.print_stats()
+        # 打印统计信息
+        client.print_stats()
 
 
 if __name__ == "__main__":
+    # 已安装 uvloop 时使用更快的事件循环
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    
     asyncio.run(main()) 
\ No newline at end of file